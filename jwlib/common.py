@@ -85,8 +85,11 @@ class Settings:
     download_subtitles = False  # type: bool
     friendly_filenames = False  # type: bool
     rate_limit = 1.0  # type: float # MB/s
+    parallel_chunks = 4  # type: int # connections per download when not rate limited
     checksums = False  # type: bool
     overwrite_bad = False  # type: bool
+    paranoid = False  # type: bool # always calculate checksums of whole files
+    quick_check = False  # type: bool # only sample start and end of modified files
 
     # Output stuff
     append = False  # type: bool
@@ -1,14 +1,58 @@
+import dbm
 import hashlib
+import heapq
+import mmap
+import os
+import select
+import shelve
 import shutil
+import sys
+import threading
 import time
+import urllib.error
 import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from queue import Queue
 from sys import stderr
-from typing import List
+from typing import Dict, List
 
 from .common import Path, Settings, msg
 from .parse import Category, Media
 
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+try:
+    import xxhash
+    # xxh3 was added in xxhash 2.0
+    if not hasattr(xxhash, 'xxh3_64'):
+        xxhash = None
+except ImportError:
+    xxhash = None
+
+# Reuse connections between downloads, if possible
+if urllib3:
+    _http = urllib3.PoolManager(num_pools=4, maxsize=16, retries=urllib3.Retry(3, backoff_factor=0.3))
+else:
+    _http = None
+
+
+# Stores MD5 sums of downloaded files, so they don't have to be re-calculated every run
+MD5_CACHE = '.md5cache.db'
+# Bytes to sample from each end of a file when checking if it has changed
+FASTCHECK_SIZE = 64 * 1024
+
+
+# All possible progress bars, ####----- (padded to 70 chars)
+_BARS = [('#' * i).ljust(70, '-') for i in range(71)]
+
+# Smaller downloads than this are not worth splitting up over multiple connections
+MIN_PARALLEL_SIZE = 16 * 1024 * 1024
+
 
 class MissingTimestampError(Exception):
     pass
@@ -18,6 +62,65 @@ class DiskLimitReached(Exception):
     pass
 
 
+class Md5Cache:
+    """Database of (size, mtime_ns, md5, sample) tuples by file path
+
+    Use it in a with-statement to keep the database open.
+    It's safe to share between threads.
+    If the database can't be opened, nothing gets cached.
+    """
+
+    def __init__(self, file: Path, create=True):
+        """
+        :param file: Database file
+        :param create: Create the database if it doesn't exist (otherwise only update an existing one)
+        """
+        self.file = file
+        self.create = create
+        self._db = None
+        # shelve isn't thread safe
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        try:
+            self._db = shelve.open(str(self.file), flag='c' if self.create else 'w')
+        except dbm.error:
+            # Cache is missing, not writable or corrupt, do it the slow way
+            self._db = None
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def get(self, key: str):
+        """Return a (size, mtime_ns, md5, sample) tuple, or None"""
+
+        with self._lock:
+            if self._db is None:
+                return None
+            try:
+                return self._db.get(key)
+            except dbm.error:
+                return None
+
+    def set(self, key: str, record: tuple = None):
+        """Store a (size, mtime_ns, md5, sample) tuple, or remove it if None"""
+
+        with self._lock:
+            if self._db is None:
+                return
+            try:
+                if record:
+                    self._db[key] = record
+                else:
+                    self._db.pop(key, None)
+            except dbm.error:
+                pass
+
+
 def download_all(s: Settings, data: List[Category]):
     """Download/check media files"""
 
@@ -36,38 +139,60 @@ def download_all(s: Settings, data: List[Category]):
     if not s.download:
         return
 
-    # Search for local media before initiating the download
-    # (to get correct progress info for the download in next step)
-    if s.quiet < 1:
-        msg('scanning local files')
-
-    checked_files = []
-    download_list = []
-    for media in media_list:
-        # Only run this check once per filename
-        # (there may be multiple Media objects referring to the same file)
-        if media.filename not in checked_files:
-            checked_files.append(media.filename)
-            if not check_media(s, media, wd):
-                # Queue missing or bad files
-                download_list.append(media)
-
-    # Start downloading
-    for num, media in enumerate(download_list):
-        if s.keep_free > 0:
-            try:
-                disk_cleanup(s, wd, media)
-            except MissingTimestampError:
-                if s.quiet < 2:
-                    msg('low disk space and missing metadata, skipping: {}'.format(media.name))
-                continue
-            except DiskLimitReached:
-                return
+    # Keep the MD5 cache open for the whole run, opening it may be slow.
+    # Without --checksum there is no need to create it, but an existing one must be kept up to date.
+    with Md5Cache(s.work_dir / MD5_CACHE, create=s.checksums) as cache:
 
-        # Download the video
-        if s.quiet < 2:
-            print('[{}/{}]'.format(num + 1, len(download_list)), end=' ', file=stderr)
-        download_media(s, media, wd)
+        # Search for local media before initiating the download
+        # (to get correct progress info for the download in next step)
+        if s.quiet < 1:
+            msg('scanning local files')
+
+        # List the directory once instead of checking each file separately
+        try:
+            index = {entry.name: entry for entry in os.scandir(str(wd))}
+        except FileNotFoundError:
+            index = {}
+
+        checked_files = set()
+        check_list = []
+        for media in media_list:
+            # Only run this check once per filename
+            # (there may be multiple Media objects referring to the same file)
+            if media.filename not in checked_files:
+                checked_files.add(media.filename)
+                check_list.append(media)
+
+        def check(m):
+            return check_media(s, m, wd, index, cache)
+
+        if s.overwrite_bad and s.checksums:
+            # Checksums can be calculated on multiple cores at once
+            with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+                results = list(executor.map(check, check_list))
+        else:
+            # Only looking in the index, no need for threads
+            results = [check(m) for m in check_list]
+
+        # Queue missing or bad files
+        download_list = [media for media, ok in zip(check_list, results) if not ok]
+
+        # Start downloading
+        for num, media in enumerate(download_list):
+            if s.keep_free > 0:
+                try:
+                    disk_cleanup(s, wd, media, cache)
+                except MissingTimestampError:
+                    if s.quiet < 2:
+                        msg('low disk space and missing metadata, skipping: {}'.format(media.name))
+                    continue
+                except DiskLimitReached:
+                    return
+
+            # Download the video
+            if s.quiet < 2:
+                print('[{}/{}]'.format(num + 1, len(download_list)), end=' ', file=stderr)
+            download_media(s, media, wd, cache)
 
 
 def download_all_subtitles(s: Settings, media_list: List[Media], directory: Path):
@@ -83,13 +208,28 @@ def download_all_subtitles(s: Settings, media_list: List[Media], directory: Path
         if s.overwrite_bad or not (directory / media.subtitle_filename).exists()
     )
 
-    for i, media in enumerate(queue):
-        if s.quiet < 2:
-            msg('[{}/{}] downloading: {}'.format(i + 1, len(queue), media.subtitle_filename))
-        download_file(media.subtitle_url, directory / media.subtitle_filename)
+    if not queue:
+        return
+
+    # Subtitles are small, so most of the time is spent waiting for the server.
+    # Download many at once.
+    with ThreadPoolExecutor(max_workers=min(16, len(queue))) as executor:
+        futures = {executor.submit(download_file, media.subtitle_url, directory / media.subtitle_filename): media
+                   for media in queue}
+        try:
+            for i, future in enumerate(as_completed(futures)):
+                # Raise any exception from the download
+                future.result()
+                if s.quiet < 2:
+                    msg('[{}/{}] downloaded: {}'.format(i + 1, len(queue), futures[future].subtitle_filename))
+        except BaseException:
+            # Don't start the remaining downloads while the executor shuts down
+            for future in futures:
+                future.cancel()
+            raise
 
 
-def check_media(s: Settings, media: Media, directory: Path):
+def check_media(s: Settings, media: Media, directory: Path, index: Dict[str, os.DirEntry], cache: Md5Cache):
     """Download media file and check it.
 
     Download file, check MD5 sum and size, delete file if it missmatches.
@@ -97,21 +237,26 @@ def check_media(s: Settings, media: Media, directory: Path):
     :param s: Global settings
     :param media: a Media instance
     :param directory: dir where files are located
+    :param index: DirEntry objects of the files in directory, by name
+    :param cache: MD5 cache
     :return: True if check is successful
     """
     file = directory / media.filename
-    if not file.exists():
+    try:
+        # DirEntry caches the stat result
+        size = index[media.filename].stat().st_size
+    except (KeyError, OSError):
         return False
 
     # If we are going to fix bad files, check the existing ones
     if s.overwrite_bad:
 
-        if media.size and file.size != media.size:
+        if media.size and size != media.size:
             if s.quiet < 2:
                 msg('size mismatch: {}'.format(file))
             return False
 
-        if s.checksums and media.md5 and _md5(file) != media.md5:
+        if s.checksums and media.md5 and _md5_cached(s, cache, file) != media.md5:
             if s.quiet < 2:
                 msg('checksum mismatch: {}'.format(file))
             return False
@@ -119,26 +264,40 @@ def check_media(s: Settings, media: Media, directory: Path):
     return True
 
 
-def download_media(s: Settings, media: Media, directory: Path):
+def download_media(s: Settings, media: Media, directory: Path, cache: Md5Cache):
     """Download media file and check it.
 
     :param s: Global settings
     :param media: a Media instance
     :param directory: dir to save the files to
+    :param cache: MD5 cache
     :return: True if download was successful
     """
     directory.mkdir(exist_ok=True)
     file = directory / media.filename
     tmpfile = directory / (media.filename + '.part')
 
+    # A killed multi-connection download leaves a full size file with holes in it, start over
+    if _ranges_marker(tmpfile).exists():
+        if s.quiet < 2:
+            msg('unfinished download, deleting: {}'.format(tmpfile))
+        if tmpfile.exists():
+            tmpfile.unlink()
+        _ranges_marker(tmpfile).unlink()
+
     # Check for partially downloaded files
     if tmpfile.exists():
+        hasher = None
 
         # If file is smaller, resume download
         if media.size and tmpfile.size < media.size:
             if s.quiet < 2:
                 msg('resuming: {} ({})'.format(media.filename, media.name))
-            download_file(media.url, tmpfile, resume=True, rate_limit=s.rate_limit, progress=s.quiet < 1)
+            if media.md5:
+                # Hash what we have so far, the rest gets hashed while downloading
+                hasher = _md5_hasher(tmpfile)
+            download_file(media.url, tmpfile, resume=True, rate_limit=s.rate_limit, progress=s.quiet < 1,
+                          connections=s.parallel_chunks, hasher=hasher)
 
         # Always validate size and MD5 on resumed downloads
         if media.size and tmpfile.size != media.size:
@@ -146,7 +305,7 @@ def download_media(s: Settings, media: Media, directory: Path):
                 msg('size mismatch, deleting: {}'.format(tmpfile))
             # Always remove resumed files that have wrong size
             tmpfile.unlink()
-        elif media.md5 and _md5(tmpfile) != media.md5:
+        elif media.md5 and (hasher.hexdigest() if hasher else _md5(tmpfile)) != media.md5:
             if s.quiet < 2:
                 msg('checksum mismatch, deleting: {}'.format(tmpfile))
             # Always remove resumed files that are broken
@@ -157,12 +316,20 @@ def download_media(s: Settings, media: Media, directory: Path):
             if media.date:
                 tmpfile.set_mtime(media.date)
             tmpfile.rename(file)
+            if hasher:
+                _md5_remember(cache, file, hasher.hexdigest())
+            else:
+                _md5_forget(cache, file)
+            _drop_page_cache(file)
             return True
 
     # Continuing to regular download
     if s.quiet < 2:
         msg('downloading: {} ({})'.format(media.filename, media.name))
-    download_file(media.url, tmpfile, rate_limit=s.rate_limit, progress=s.quiet < 1)
+    # Calculate MD5 while downloading, instead of reading the file again afterwards
+    hasher = hashlib.md5() if s.checksums and media.md5 else None
+    download_file(media.url, tmpfile, rate_limit=s.rate_limit, progress=s.quiet < 1,
+                  connections=s.parallel_chunks, hasher=hasher)
 
     # Check exist and non-empty
     try:
@@ -178,6 +345,7 @@ def download_media(s: Settings, media: Media, directory: Path):
     if media.date:
         tmpfile.set_mtime(media.date)
     tmpfile.rename(file)
+    _md5_forget(cache, file)
 
     # Check size (log only)
     if media.size and file.size != media.size:
@@ -185,10 +353,14 @@ def download_media(s: Settings, media: Media, directory: Path):
             msg('size mismatch: {}'.format(file))
         return False
     # Check MD5 if size was correct (optional, log only)
-    elif s.checksums and media.md5 and _md5(file) != media.md5:
-        if s.quiet < 2:
+    elif hasher:
+        # Only read the file again if we're paranoid
+        md5 = _md5(file) if s.paranoid else hasher.hexdigest()
+        _md5_remember(cache, file, md5)
+        if md5 != media.md5 and s.quiet < 2:
             msg('checksum mismatch: {}'.format(file))
 
+    _drop_page_cache(file)
     return True
 
 
@@ -208,23 +380,169 @@ def disk_usage_info(s: Settings):
                   'currently downloaded videos may get deleted.\n'
         msg(message.format((s.keep_free - free) // 1024 ** 2))
         try:
-            if not input('Do you want to proceed anyway? [y/N]: ') in ('y', 'Y'):
+            if not _input_timeout('Do you want to proceed anyway? [y/N]: ', 30) in ('y', 'Y'):
                 exit(1)
         except EOFError:
             exit(1)
 
 
+def _input_timeout(prompt: str, timeout: float):
+    """Like input(), but raise EOFError if there is no answer within timeout seconds
+
+    (The timeout is not supported on Windows)
+    """
+
+    if os.name == 'nt':
+        return input(prompt)
+
+    print(prompt, end='', flush=True)
+    ready, _, _ = select.select([sys.stdin], [], [], timeout)
+    if not ready:
+        print()
+        raise EOFError
+    line = sys.stdin.readline()
+    if not line:
+        raise EOFError
+    return line.rstrip('\n')
+
+
 def _md5(file: Path):
     """Return MD5 of a file."""
 
+    return _md5_hasher(file).hexdigest()
+
+
+def _md5_hasher(file: Path):
+    """Return a hashlib MD5 object that has been fed the contents of a file.
+
+    The file is memory mapped and hashed in one go, if possible.
+    On Python < 3.11 the file is otherwise read in a separate thread, so that reading and hashing can overlap.
+    """
+
+    # Let hashlib read straight from the page cache
+    with file.open('rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.md5(mm)
+        except (ValueError, OverflowError, OSError):
+            # Empty file, or too big for the address space (32-bit systems)
+            pass
+
+    # Let hashlib do the whole loop in C
+    if sys.version_info >= (3, 11):
+        with file.open('rb') as f:
+            return hashlib.file_digest(f, 'md5')
+
     hash_md5 = hashlib.md5()
+    # Keep a few chunks in memory at most
+    chunks = Queue(maxsize=4)
+    errors = []
+
+    def reader():
+        try:
+            with file.open('rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    chunks.put(chunk)
+        except OSError as e:
+            errors.append(e)
+        finally:
+            # Sentinel
+            chunks.put(None)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    for chunk in iter(chunks.get, None):
+        hash_md5.update(chunk)
+    thread.join()
+
+    # Pass on any read errors to the caller, like before
+    if errors:
+        raise errors[0]
+    return hash_md5
+
+
+def _md5_cached(s: Settings, cache: Md5Cache, file: Path):
+    """Return MD5 of a file, using the cache
+
+    The cache entry is used if size and modification time are unchanged.
+    With --quick-check, if only the modification time has changed, the start and
+    end of the file are compared with a sample taken when the MD5 was calculated.
+    With --paranoid the cache is never used.
+    """
+
+    key = str(file.absolute())
+    stat = file.stat()
+    size, mtime_ns, md5, sample = cache.get(key) or (None, None, None, None)
+    if not s.paranoid and size == stat.st_size:
+        if mtime_ns == stat.st_mtime_ns:
+            return md5
+        # Use the same algorithm as when the sample was taken
+        if s.quick_check and sample and sample == _fastcheck(file, size, sample.split(':')[0]):
+            cache.set(key, (size, stat.st_mtime_ns, md5, sample))
+            return md5
+
+    md5 = _md5(file)
+    cache.set(key, (stat.st_size, stat.st_mtime_ns, md5, _fastcheck(file, stat.st_size)))
+    return md5
+
+
+def _fastcheck(file: Path, size: int, algorithm: str = None):
+    """Return a hash of the first and last 64 KiB of a file
+
+    This is only compared with other samples, so it uses xxh3 if available, otherwise MD5.
+
+    :param file: File to sample
+    :param size: Size of the file
+    :param algorithm: 'xxh3' or 'md5' (default: fastest available)
+    :return: String like 'algorithm:hexdigest', or None if the algorithm is unavailable
+    """
+
+    if not algorithm:
+        algorithm = 'xxh3' if xxhash else 'md5'
+
+    if algorithm == 'xxh3' and xxhash:
+        hasher = xxhash.xxh3_64()
+    elif algorithm == 'md5':
+        hasher = hashlib.md5()
+    else:
+        return None
+
     with file.open('rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+        hasher.update(f.read(FASTCHECK_SIZE))
+        f.seek(max(size - FASTCHECK_SIZE, 0))
+        hasher.update(f.read(FASTCHECK_SIZE))
+    return '{}:{}'.format(algorithm, hasher.hexdigest())
+
+
+def _md5_remember(cache: Md5Cache, file: Path, md5: str):
+    """Add a file with known MD5 to the cache"""
+
+    stat = file.stat()
+    cache.set(str(file.absolute()), (stat.st_size, stat.st_mtime_ns, md5, _fastcheck(file, stat.st_size)))
+
+
+def _md5_forget(cache: Md5Cache, file: Path):
+    """Remove a file from the MD5 cache"""
+
+    cache.set(str(file.absolute()))
+
+
+def _drop_page_cache(file: Path):
+    """Tell the OS we won't read this file again soon, so it can be removed from the page cache"""
+
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(str(file), os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
 
 
-def download_file(url: str, file: Path, resume=False, rate_limit=0.0, progress=False):
+def download_file(url: str, file: Path, resume=False, rate_limit=0.0, progress=False, connections=1, hasher=None):
     """Throttled download with progress bar
 
     :param url: URL to download
@@ -232,8 +550,16 @@ def download_file(url: str, file: Path, resume=False, rate_limit=0.0, progress=F
     :param resume: Append instead of overwrite
     :param rate_limit: Rate limit in MB/s
     :param progress: Show progress bar
+    :param connections: Split large unthrottled downloads over this many connections
+    :param hasher: hashlib object to update with the downloaded data (disables multiple connections)
     """
 
+    # A multi-connection download that got killed leaves a full size file with holes in it
+    marker = _ranges_marker(file)
+    if marker.exists():
+        file.open('wb').close()
+        marker.unlink()
+
     if resume and file.exists():
         file_mode = 'ab'
         done_bytes = file.size
@@ -241,18 +567,26 @@ def download_file(url: str, file: Path, resume=False, rate_limit=0.0, progress=F
         file_mode = 'wb'
         done_bytes = 0
 
-    # To be downloaded each second
-    if rate_limit != 0:
-        chunk_size = int(rate_limit * 1024 * 1024)
-    else:
-        # Default chunk size of 1 MB means we do not loose whole file if download gets aborted
-        chunk_size = 1024 * 1024
+    # Parallel download only makes sense when we're not throttling anyway
+    if connections > 1 and not rate_limit and not hasher:
+        total_bytes = _get_ranged_size(url)
+        if total_bytes - done_bytes >= MIN_PARALLEL_SIZE:
+            _download_ranges(url, file, done_bytes, total_bytes, connections, progress)
+            return
 
-    # Ask server to skip the first N bytes
-    request = urllib.request.Request(url)
-    request.add_header('Range', 'bytes={}-'.format(done_bytes))
+    # Small chunks means we do not loose much if download gets aborted, and gives smooth throttling
+    chunk_size = 256 * 1024
+
+    # Token bucket for the rate limit, it holds the number of bytes we may download right now
+    rate = rate_limit * 1024 * 1024  # B/s
+    tokens = 0.0
+    last = time.monotonic()
 
-    with urllib.request.urlopen(request) as response:
+    # Time of the last progress bar update
+    last_draw = 0.0
+
+    # Ask server to skip the first N bytes
+    with _open_url(url, headers={'Range': 'bytes={}-'.format(done_bytes)}) as response:
         if progress:
             # Get size of download
             total_bytes = int(response.headers['content-length']) + done_bytes
@@ -261,35 +595,203 @@ def download_file(url: str, file: Path, resume=False, rate_limit=0.0, progress=F
                 progress = False
 
         with file.open(file_mode) as f:
+            # Nothing to do in between chunks, let shutil do the copying
+            if not progress and not rate_limit and not hasher:
+                shutil.copyfileobj(response, f, 1024 * 1024)
+                return
+
             while True:
-                # Print a progress bar
-                if progress:
-                    percent = 100 * (done_bytes / total_bytes)
-                    # Never more than 70 hash signs
-                    bar = '#' * min(70 * done_bytes // total_bytes, 70)
-                    ####----- (padded to 70 chars) NNN.N (padded to 5 chars) %
-                    print('\r{:-<70} {: >5.1f}%'.format(bar, percent), end='', flush=True, file=stderr)
+                # Print a progress bar (no more than 10 times per second)
+                if progress and time.monotonic() - last_draw > 0.1:
+                    _print_progress(done_bytes, total_bytes)
+                    last_draw = time.monotonic()
 
                 # Download and write a chunk
-                started = time.time()
                 chunk = response.read(chunk_size)
                 done_bytes += len(chunk)
                 if not chunk:
                     if progress:
+                        _print_progress(done_bytes, total_bytes)
                         print()  # newline when done
                     break
                 f.write(chunk)
+                if hasher:
+                    hasher.update(chunk)
 
                 if rate_limit:
-                    try:
-                        # Every chunk should take 1 second, sleep for the time that's left
-                        time.sleep(1 + started - time.time())
-                    except ValueError:
-                        pass
+                    # Refill the bucket for the time that has passed (but don't allow big bursts)
+                    now = time.monotonic()
+                    tokens = min(tokens + (now - last) * rate, 4 * rate) - len(chunk)
+                    last = now
+                    # Wait until the debt is paid back
+                    if tokens < 0:
+                        time.sleep(-tokens / rate)
+
+
+@contextmanager
+def _open_url(url: str, method='GET', headers: Dict[str, str] = None):
+    """Open a URL and return a file-like response with status and headers
+
+    Uses the urllib3 connection pool if available, otherwise urllib
+    (which also takes care of proxies).
+    HTTP errors raise urllib.error.HTTPError and other connection errors
+    raise urllib.error.URLError in both cases.
+    """
+
+    if not _http or _uses_proxy(url):
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers or {}, method=method)) as response:
+            yield response
+        return
+
+    try:
+        response = _http.request(method, url, headers=headers, preload_content=False)
+    except urllib3.exceptions.HTTPError as e:
+        raise urllib.error.URLError(e) from e
+
+    try:
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+        yield response
+    except urllib3.exceptions.HTTPError as e:
+        # Error while reading
+        response.close()
+        raise urllib.error.URLError(e) from e
+    except BaseException:
+        response.close()
+        raise
+
+    # Only put the connection back in the pool if the whole body was read,
+    # otherwise the next request would get the leftovers
+    if response.length_remaining == 0:
+        response.release_conn()
+    else:
+        response.close()
 
 
-def disk_cleanup(s: Settings, directory: Path, reference_media: Media):
-    """Clean up old videos until there is enough space"""
+def _uses_proxy(url: str):
+    """True if urllib would connect to this URL through a proxy (http_proxy, no_proxy etc)"""
+
+    parts = urllib.parse.urlsplit(url)
+    return parts.scheme in urllib.request.getproxies() and not urllib.request.proxy_bypass(parts.netloc)
+
+
+def _print_progress(done_bytes: int, total_bytes: int):
+    """Print a progress bar (without newline)"""
+
+    percent = 100 * (done_bytes / total_bytes)
+    # Never more than 70 hash signs
+    bar = _BARS[min(70 * done_bytes // total_bytes, 70)]
+    ####----- NNN.N (padded to 5 chars) %
+    print('\r{} {: >5.1f}%'.format(bar, percent), end='', flush=True, file=stderr)
+
+
+def _get_ranged_size(url: str):
+    """Return size of a download, or 0 if the server doesn't support byte ranges"""
+
+    try:
+        with _open_url(url, method='HEAD') as response:
+            if response.headers.get('accept-ranges') != 'bytes':
+                return 0
+            return int(response.headers.get('content-length', 0))
+    except (OSError, ValueError):
+        return 0
+
+
+def _download_ranges(url: str, file: Path, done_bytes: int, total_bytes: int, connections: int, progress: bool):
+    """Download the rest of a file over multiple connections, each fetching its own byte range
+
+    :param url: URL to download
+    :param file: Output file, already containing done_bytes bytes
+    :param done_bytes: Start downloading from here
+    :param total_bytes: Size of the complete file
+    :param connections: Number of parallel connections
+    :param progress: Show progress bar
+    """
+
+    # Split the remaining bytes into equally large ranges
+    step = -(-(total_bytes - done_bytes) // connections)
+    ranges = [(start, min(start + step, total_bytes)) for start in range(done_bytes, total_bytes, step)]
+    written = [0] * len(ranges)
+
+    lock = threading.Lock()
+    abort = threading.Event()
+    progress = progress and stderr.isatty()
+    last_draw = 0.0
+
+    def worker(index):
+        nonlocal last_draw
+        start, end = ranges[index]
+        with _open_url(url, headers={'Range': 'bytes={}-{}'.format(start, end - 1)}) as response, \
+                file.open('r+b') as f:
+            if response.status != 206:
+                raise OSError('server ignored byte range: {}'.format(url))
+            f.seek(start)
+            while not abort.is_set() and written[index] < end - start:
+                chunk = response.read(min(1024 * 1024, end - start - written[index]))
+                if not chunk:
+                    raise OSError('connection closed early: {}'.format(url))
+                f.write(chunk)
+                written[index] += len(chunk)
+                # Print a progress bar (no more than 10 times per second)
+                if progress and time.monotonic() - last_draw > 0.1:
+                    with lock:
+                        _print_progress(done_bytes + sum(written), total_bytes)
+                        last_draw = time.monotonic()
+
+    # The file will be full size before it's complete, mark it as incomplete until we're done
+    marker = _ranges_marker(file)
+    marker.touch()
+
+    # Make room for all ranges, preferably as one contiguous block
+    with file.open('ab') as f:
+        # Throw away anything after done_bytes, like 'wb' would when not resuming
+        f.truncate(done_bytes)
+        try:
+            os.posix_fallocate(f.fileno(), done_bytes, total_bytes - done_bytes)
+        except (AttributeError, OSError):
+            # Not supported by the OS or file system
+            f.truncate(total_bytes)
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(worker, i) for i in range(len(ranges))]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # Stop the other workers before the executor waits for them
+                abort.set()
+                raise
+        marker.unlink()
+        if progress:
+            _print_progress(total_bytes, total_bytes)
+    except BaseException:
+        # Throw away everything after the first gap, so that the download can be resumed
+        complete = done_bytes
+        for (start, end), count in zip(ranges, written):
+            complete += count
+            if count < end - start:
+                break
+        with file.open('r+b') as f:
+            f.truncate(complete)
+        marker.unlink()
+        raise
+    finally:
+        if progress:
+            print()  # newline when done
+
+
+def _ranges_marker(file: Path):
+    """Return path of the file that marks an unfinished multi-connection download"""
+
+    return file.parent / (file.name + '.ranges')
+
+
+def disk_cleanup(s: Settings, directory: Path, reference_media: Media, cache: Md5Cache = None):
+    """Clean up old videos until there is enough space
+
+    :param cache: MD5 cache to remove deleted files from
+    """
     assert s.keep_free
     assert reference_media.size
 
@@ -297,8 +799,12 @@ def disk_cleanup(s: Settings, directory: Path, reference_media: Media):
     if not directory.exists():
         return
 
+    # Queue of (mtime, path, size) for all MP4 files, oldest first (created when needed)
+    videos = None
+    deleted = 0
+    space = shutil.disk_usage(str(directory)).free
+
     while True:
-        space = shutil.disk_usage(str(directory)).free
         needed = reference_media.size + s.keep_free
         if space > needed:
             break
@@ -309,16 +815,23 @@ def disk_cleanup(s: Settings, directory: Path, reference_media: Media):
         if not reference_media.date:
             raise MissingTimestampError
 
+        # Scan the working directory once, DirEntry caches the stat result
+        if videos is None:
+            videos = [(entry.stat().st_mtime, entry.path, entry.stat().st_size)
+                      for entry in os.scandir(str(directory))
+                      if entry.name.lower().endswith('.mp4') and entry.is_file()]
+            heapq.heapify(videos)
+
         try:
             # Get the oldest .mp4 file in the working directory
-            oldest = min((f for f in directory.iterdir() if f.is_mp4()), key=lambda f: f.mtime)
-        except ValueError:
+            oldest_mtime, oldest, oldest_size = heapq.heappop(videos)
+        except IndexError:
             msg('cannot free more disk space, no videos in {}'.format(directory))
             exit(1)
             raise
 
         # If the reference date is older than the oldest file, exit the program.
-        if reference_media.date <= oldest.mtime:
+        if reference_media.date <= oldest_mtime:
             if s.quiet < 1:
                 msg('disk limit reached, all videos up to date')
             raise DiskLimitReached
@@ -326,7 +839,16 @@ def disk_cleanup(s: Settings, directory: Path, reference_media: Media):
         # Delete the file and add a "deleted" marker
         if s.quiet < 2:
             msg('removing old video: {}'.format(oldest))
-        oldest.unlink()
+        os.unlink(oldest)
+        if cache:
+            _md5_forget(cache, Path(oldest))
+
+        # Predict the free space, but ask the OS now and then in case something else is writing to the disk
+        deleted += 1
+        if deleted % 32 == 0:
+            space = shutil.disk_usage(str(directory)).free
+        else:
+            space += oldest_size
 
 
 def copy_files(s: Settings):
@@ -352,12 +874,14 @@ def copy_files(s: Settings):
     source_files.sort(key=lambda x: x.date, reverse=True)
 
     total = len(source_files)
-    for source_file in source_files:
+    for i, source_file in enumerate(source_files):
         if s.keep_free > 0:
             disk_cleanup(s, directory=dest_dir, reference_media=source_file)
 
         if s.quiet < 1:
-            i = source_files.index(source_file)
             msg('copying [{}/{}]: {}'.format(i + 1, total, source_file.name))
 
-        shutil.copy2(source_file.path, dest_dir / source_file.name)
+        # copyfile can let the kernel do the copying, then we only need the timestamp
+        dest_file = dest_dir / source_file.name
+        shutil.copyfile(str(source_file), str(dest_file))
+        dest_file.set_mtime(source_file.mtime)
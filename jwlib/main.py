@@ -54,6 +54,8 @@ def main():
                    help="validate MD5 checksums")
     p.add_argument('--clean-symlinks', action='store_true', dest='clean_all_symlinks',
                    help='remove all old symlinks (mode=filesystem)')
+    p.add_argument('--connections', type=int, metavar='N', dest='parallel_chunks',
+                   help='split large downloads over N connections when there is no rate limit (default = 4)')
     p.add_argument('--download', '-d', action='store_true',
                    help='download media files')
     p.add_argument('--download-subtitles', action='store_true',
@@ -87,9 +89,14 @@ def main():
                    help='output mode (see wiki)')
     p.add_argument('--no-warning', dest='warning', action='store_false',
                    help='do not warn when space limit seems wrong')
+    p.add_argument('--paranoid', action='store_true',
+                   help='do not trust cached checksums, always check the whole file (with --checksum)')
     p.add_argument('--quality', '-Q', type=int,
                    choices=[240, 360, 480, 720],
                    help='maximum video quality')
+    p.add_argument('--quick-check', action='store_true',
+                   help='only check the first and last 64 KiB of files modified since their checksum was cached '
+                        '(with --checksum, faster but changes in the middle of a file go unnoticed)')
     p.add_argument('--quiet', '-q', action='count',
                    help='Less info, can be used multiple times')
     p.add_argument('--since', metavar='YYYY-MM-DD', dest='min_date',